@@ -1,5 +1,9 @@
 import os
+
+import numpy as np
 import pandas as pd
+import polars as pl
+import xlsxwriter
 
 # =========================
 # 0) Path config
@@ -11,124 +15,148 @@ ITEMS_FILE    = os.path.join(BASE_DIR, "olist_order_items_dataset.csv")
 PAYMENTS_FILE = os.path.join(BASE_DIR, "olist_order_payments_dataset.csv")  # optional
 
 # Output (production-friendly names)
-OUT_CSV  = os.path.join(BASE_DIR, "daily_ops_metrics.csv")
-OUT_XLSX = os.path.join(BASE_DIR, "daily_ops_metrics.xlsx")
+OUT_PARQUET = os.path.join(BASE_DIR, "daily_ops_metrics.parquet")  # read by detect_anomalies.py
+OUT_CSV     = os.path.join(BASE_DIR, "daily_ops_metrics.csv")
+OUT_XLSX    = os.path.join(BASE_DIR, "daily_ops_metrics.xlsx")
+
+# =========================
+# 0.5) Columnar copies of the raw CSVs
+# =========================
+# The CSVs are parsed once into a Snappy Parquet file next to them; later runs
+# read only the columns they need. The copy is rebuilt when the CSV is newer.
+# Timestamps are parsed and low-cardinality strings categorized at conversion
+# time, so no run pays for string parsing again.
+def parquet_copy(csv_path, schema_overrides=None, parse_dates=()):
+    parquet_path = os.path.splitext(csv_path)[0] + ".parquet"
+    if (
+        not os.path.exists(parquet_path)
+        or os.path.getmtime(parquet_path) < os.path.getmtime(csv_path)
+    ):
+        (
+            pl.scan_csv(csv_path, schema_overrides=schema_overrides)
+            .with_columns([pl.col(c).str.to_datetime(strict=False) for c in parse_dates])
+            .sink_parquet(parquet_path, compression="snappy")
+        )
+    return parquet_path
 
 # =========================
 # 1) Load orders (minimal cols)
 # =========================
+# Everything up to the daily KPI table is one lazy Polars plan: the Parquet
+# copies are only scanned (with projection pushdown) when it is collected in 5).
 if not os.path.exists(ORDERS_FILE):
     raise FileNotFoundError(f"Missing: {ORDERS_FILE}")
 
-orders = pd.read_csv(
-    ORDERS_FILE,
-    usecols=[
+orders_lf = (
+    pl.scan_parquet(parquet_copy(
+        ORDERS_FILE,
+        schema_overrides={"order_status": pl.Categorical},
+        parse_dates=["order_purchase_timestamp", "order_delivered_customer_date"],
+    ))
+    .select([
         "order_id",
         "order_status",
         "order_purchase_timestamp",
         "order_delivered_customer_date",
-    ],
+    ])
+    # Use full available range (simulation mode B needs full history)
+    .drop_nulls("order_purchase_timestamp")
+    .with_columns(
+        purchase_date=pl.col("order_purchase_timestamp").dt.date(),
+        is_canceled=pl.col("order_status")
+        .is_in(["canceled", "unavailable"])
+        .cast(pl.UInt8),
+    )
 )
 
-orders["order_purchase_timestamp"] = pd.to_datetime(
-    orders["order_purchase_timestamp"], errors="coerce"
+coverage_lf = orders_lf.select(
+    min_ts=pl.col("order_purchase_timestamp").min(),
+    max_ts=pl.col("order_purchase_timestamp").max(),
+    # orders_count below counts rows, which relies on one row per order_id
+    duplicate_order_ids=pl.len() - pl.col("order_id").n_unique(),
 )
-orders["purchase_date"] = orders["order_purchase_timestamp"].dt.date
-
-# Use full available range (simulation mode B needs full history)
-orders = orders.dropna(subset=["order_purchase_timestamp"]).copy()
-if orders.empty:
-    raise ValueError("No valid order_purchase_timestamp after parsing.")
-
-min_ts = orders["order_purchase_timestamp"].min()
-max_ts = orders["order_purchase_timestamp"].max()
-print(f"Data coverage (orders): {min_ts} -> {max_ts}")
 
 # =========================
-# 2) Load items (minimal cols) and join to orders
+# 2) Load items (minimal cols), revenue per order
 # =========================
 if not os.path.exists(ITEMS_FILE):
     raise FileNotFoundError(f"Missing: {ITEMS_FILE}")
 
-items = pd.read_csv(
-    ITEMS_FILE,
-    usecols=["order_id", "price", "freight_value"],
-)
-
-# Keep only items that belong to orders we have
-items = items.merge(
-    orders[["order_id", "purchase_date"]],
-    on="order_id",
-    how="inner",
-)
-
-# Items-based revenue definition (includes freight as you did)
-items["item_revenue"] = items["price"].fillna(0) + items["freight_value"].fillna(0)
+items_lf = pl.scan_parquet(parquet_copy(ITEMS_FILE)).select(["order_id", "price", "freight_value"])
 
-daily_revenue_items = (
-    items.groupby("purchase_date", as_index=False)["item_revenue"]
-    .sum()
-    .rename(columns={"purchase_date": "date", "item_revenue": "revenue_items"})
+# Items-based revenue definition (includes freight as you did).
+# sum_horizontal skips nulls, i.e. price/freight fill_null(0) fused into the add.
+items_by_order = items_lf.group_by("order_id").agg(
+    item_revenue=pl.sum_horizontal("price", "freight_value").sum()
 )
 
 # =========================
-# 3) Daily orders + canceled orders
-# =========================
-# Note: canceled_orders here = count of orders whose status is canceled/unavailable
-orders_daily = (
-    orders.groupby("purchase_date", as_index=False)
-    .agg(
-        orders_count=("order_id", "nunique"),
-        canceled_orders=("order_status", lambda s: (s.isin(["canceled", "unavailable"])).sum()),
-    )
-    .rename(columns={"purchase_date": "date"})
-)
-
-# =========================
-# 4) (Optional) Payments-based revenue
+# 3) (Optional) Payments-based revenue per order
 # =========================
 has_payments = os.path.exists(PAYMENTS_FILE)
 
 if has_payments:
-    payments = pd.read_csv(PAYMENTS_FILE, usecols=["order_id", "payment_value"])
-
-    payments = payments.merge(
-        orders[["order_id", "purchase_date"]],
-        on="order_id",
-        how="inner",
-    )
-
-    daily_revenue_payments = (
-        payments.groupby("purchase_date", as_index=False)["payment_value"]
-        .sum()
-        .rename(columns={"purchase_date": "date", "payment_value": "revenue_payments"})
-    )
+    payments_lf = pl.scan_parquet(parquet_copy(PAYMENTS_FILE)).select(["order_id", "payment_value"])
+    pay_by_order = payments_lf.group_by("order_id").agg(pl.col("payment_value").sum())
 else:
-    daily_revenue_payments = None
+    pay_by_order = None
 
 # =========================
-# 5) Combine into final daily KPI
+# 4) Attach per-order revenue to orders
 # =========================
-daily = orders_daily.merge(daily_revenue_items, on="date", how="left")
+# Left joins onto the per-order aggregates: the join hashes those (at most one
+# row per order, never more than orders itself), and items/payments of orders
+# we don't have simply find no match - no separate order_id pre-filter needed.
+orders_lf = orders_lf.join(items_by_order, on="order_id", how="left")
+if pay_by_order is not None:
+    orders_lf = orders_lf.join(pay_by_order, on="order_id", how="left")
 
-if daily_revenue_payments is not None:
-    daily = daily.merge(daily_revenue_payments, on="date", how="left")
+# =========================
+# 5) Combine into final daily KPI (one group_by over purchase_date)
+# =========================
+# Note: canceled_orders here = count of orders whose status is canceled/unavailable
+daily_aggs = [
+    pl.len().alias("orders_count"),
+    pl.col("is_canceled").sum().alias("canceled_orders"),
+    pl.col("item_revenue").sum().alias("revenue_items"),
+]
+if has_payments:
+    daily_aggs.append(pl.col("payment_value").sum().alias("revenue_payments"))
+
+daily_lf = (
+    orders_lf.group_by("purchase_date")
+    .agg(daily_aggs)
+    .rename({"purchase_date": "date"})
+)
 
 # Choose one "official revenue" for anomaly detection
 # - If payments exist, prefer payments as official (cash-based-ish)
 # - Else fall back to items
 if has_payments:
-    daily["revenue"] = daily["revenue_payments"].fillna(0)
+    revenue = pl.col("revenue_payments").fill_null(0)
 else:
-    daily["revenue"] = daily["revenue_items"].fillna(0)
+    revenue = pl.col("revenue_items").fill_null(0)
+
+daily_lf = (
+    daily_lf.with_columns(revenue=revenue)
+    .with_columns(avg_order_value=(pl.col("revenue") / pl.col("orders_count")).round(2))
+    .sort("date")
+    # datetime64[ns] on the pandas side, so the spine below needs no re-parse
+    .with_columns(pl.col("date").cast(pl.Datetime("ns")))
+)
 
-daily["avg_order_value"] = (daily["revenue"] / daily["orders_count"]).round(2)
+# Single collect for the whole plan; the scans are shared between both outputs
+daily, coverage = pl.collect_all([daily_lf, coverage_lf], engine="streaming")
 
-# Format date as ISO string
-daily["date"] = pd.to_datetime(daily["date"]).dt.strftime("%Y-%m-%d")
+min_ts, max_ts, duplicate_order_ids = coverage.row(0)
+if min_ts is None:
+    raise ValueError("No valid order_purchase_timestamp after parsing.")
+if duplicate_order_ids:
+    raise ValueError(f"{duplicate_order_ids} duplicate order_id rows in {ORDERS_FILE}")
+print(f"Data coverage (orders): {min_ts} -> {max_ts}")
 
-# Sort
-daily = daily.sort_values("date").reset_index(drop=True)
+# The daily table is small (one row per day); finish it in pandas
+daily = daily.to_pandas()
 
 # =========================
 # 6) Basic sanity checks
@@ -136,42 +164,21 @@ daily = daily.sort_values("date").reset_index(drop=True)
 # =========================
 # 6.5) Fill missing calendar days (calendar spine)
 # =========================
-daily["date"] = pd.to_datetime(daily["date"])
+# Build full calendar range and left-join the KPIs onto it
+calendar = pd.DataFrame({
+    "date": pd.date_range(start=daily["date"].min(), end=daily["date"].max(), freq="D")
+})
+daily = calendar.merge(daily, on="date", how="left")
 
-# Build full calendar range
-full_range = pd.date_range(
-    start=daily["date"].min(),
-    end=daily["date"].max(),
-    freq="D"
-)
-
-daily = (
-    daily.set_index("date")
-         .reindex(full_range)
-         .reset_index()
-         .rename(columns={"index": "date"})
-)
-
-# Fill missing days with zeros
+# Fill missing days with zeros (KPIs plus the audit columns that exist)
 zero_cols = ["orders_count", "revenue", "canceled_orders", "avg_order_value"]
-for c in zero_cols:
-    if c in daily.columns:
-        daily[c] = daily[c].fillna(0)
-
-# Fill audit columns if they exist
-for c in ["revenue_items", "revenue_payments"]:
-    if c in daily.columns:
-        daily[c] = daily[c].fillna(0)
-
-# Recompute AOV safely
-daily["avg_order_value"] = daily.apply(
-    lambda r: round(r["revenue"] / r["orders_count"], 2)
-    if r["orders_count"] > 0 else 0,
-    axis=1
-)
+fill_cols = zero_cols + [c for c in ["revenue_items", "revenue_payments"] if c in daily.columns]
+daily[fill_cols] = daily[fill_cols].fillna(0)
 
-# Back to string date
-daily["date"] = daily["date"].dt.strftime("%Y-%m-%d")
+# Recompute AOV safely (zero-order days -> 0)
+oc = daily["orders_count"].to_numpy()
+rev = daily["revenue"].to_numpy()
+daily["avg_order_value"] = np.where(oc > 0, np.round(rev / np.maximum(oc, 1), 2), 0.0)
 
 cols = ["date", "orders_count", "revenue", "canceled_orders", "avg_order_value"]
 if has_payments:
@@ -182,11 +189,25 @@ daily = daily[cols]
 # =========================
 # 7) Export
 # =========================
-daily.to_csv(OUT_CSV, index=False)
-daily.to_excel(OUT_XLSX, index=False)
+# Parquet keeps the dtypes (date stays datetime64); CSV/XLSX are for humans.
+# daily itself is never converted: dates are formatted as ISO strings on write.
+daily.to_parquet(OUT_PARQUET, index=False)
+
+daily.to_csv(OUT_CSV, index=False, date_format="%Y-%m-%d")
+
+# Stream the sheet row by row (constant_memory keeps only the current row).
+# DataFrame.to_excel can't be used in this mode: it writes column by column.
+iso_dates = np.datetime_as_string(daily["date"].to_numpy(), unit="D")
+with xlsxwriter.Workbook(OUT_XLSX, {"constant_memory": True}) as wb:
+    ws = wb.add_worksheet()
+    ws.write_row(0, 0, daily.columns)
+    rows = zip(iso_dates, daily.drop(columns="date").itertuples(index=False))
+    for r, (day, row) in enumerate(rows, start=1):
+        ws.write_row(r, 0, (day, *row))
 
 print("✅ Done!")
 print(f"- Rows (days): {len(daily)}")
+print(f"- Output Parquet: {OUT_PARQUET}")
 print(f"- Output CSV : {OUT_CSV}")
 print(f"- Output XLSX: {OUT_XLSX}")
 print(f"- Payments file found: {has_payments}")
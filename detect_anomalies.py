@@ -1,22 +1,48 @@
 import json
 import os
 from datetime import datetime
+from functools import lru_cache
 
+import numpy as np
 import pandas as pd
+import pyarrow.parquet as pq
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    from numba import njit
+except ImportError:  # numba is optional; the kernel then runs as plain Python
+    njit = None
+
+try:
+    import orjson
+except ImportError:  # orjson is optional; falls back to the stdlib json
+    orjson = None
 
 # =========================
 # Config
 # =========================
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATA_FILE = os.path.join(BASE_DIR, "daily_ops_metrics.csv")
+DATA_FILE_PARQUET = os.path.join(BASE_DIR, "daily_ops_metrics.parquet")  # preferred if present
 STATE_FILE = os.path.join(BASE_DIR, "run_state.json")
+# scored candidate days, reused until the input file (or this script) changes
+BASELINES_FILE = os.path.join(BASE_DIR, "baselines.parquet")
 
 ROLLING_DAYS = 7
+METRICS = ["orders_count", "revenue", "canceled_orders", "avg_order_value"]
 
 # 你的 n8n production webhook
 WEBHOOK_URL = "http://127.0.0.1:5678/webhook/ops-insight"
 
+# One pooled, keep-alive session for all webhook posts (run_service.py calls
+# run_once repeatedly in the same process). Retries only cover connect errors
+# for POST, so a payload is never delivered twice.
+SESSION = requests.Session()
+SESSION.mount("http://", HTTPAdapter(pool_maxsize=4, max_retries=Retry(total=2, backoff_factor=0.2)))
+SESSION.mount("https://", HTTPAdapter(pool_maxsize=4, max_retries=Retry(total=2, backoff_factor=0.2)))
+
 # ✅ 从这里开始模拟：让 2017-01-05~2017-01-11 做 baseline
 SIM_START_DATE = "2017-01-12"
 
@@ -31,51 +57,150 @@ TH = {
     "cancel_spike_high": 1.20,
 }
 
+# (signal metric, column, direction, TH key prefix, label in details)
+SIGNAL_RULES = [
+    ("revenue", "revenue", "down", "revenue_drop", "Revenue"),
+    ("orders", "orders_count", "down", "orders_drop", "Orders"),
+    ("avg_order_value", "avg_order_value", "down", "aov_drop", "AOV"),
+    ("canceled_orders", "canceled_orders", "up", "cancel_spike", "Cancellations"),
+]
+
 # =========================
 # Helpers
 # =========================
-def pct_change(today, baseline):
-    if baseline == 0 or pd.isna(baseline):
-        return 0.0
-    return (today - baseline) / baseline
+def score_signals(df):
+    """Add change_<col> / severity_<col> for every row of df (severity "" = no signal).
+
+    change is the pct change vs base_<col> (0 when the baseline is 0 or NaN);
+    severity applies the TH thresholds in the rule's direction.
+    """
+    for _, col, direction, th, _ in SIGNAL_RULES:
+        today = df[col].to_numpy(dtype="float64")
+        base = df[f"base_{col}"].to_numpy(dtype="float64")
+        valid = (base != 0) & ~np.isnan(base)
+        change = np.divide(today - base, base, out=np.zeros_like(base), where=valid)
+        move = -change if direction == "down" else change
+        df[f"change_{col}"] = change
+        df[f"severity_{col}"] = np.select(
+            [move >= TH[f"{th}_high"], move >= TH[f"{th}_medium"]],
+            ["high", "medium"],
+            default="",
+        )
+
+def _rolling_mean_shift1(values, window, out):
+    """out[i, j] = mean of values[i-window:i, j]; NaN until a full, NaN-free window.
+
+    Same result as ``rolling(window).mean().shift(1)`` per column, computed for
+    all metrics in one pass over the rows. Each window is summed directly
+    rather than with a running add/subtract sum: the window is tiny and this
+    keeps all-zero windows at exactly 0 instead of drifting to +-1e-13, which
+    would flip pct_change into a -100% signal.
+    """
+    n, k = values.shape
+    for i in range(n):
+        for j in range(k):
+            if i < window:
+                out[i, j] = np.nan
+                continue
+            total = 0.0
+            for t in range(i - window, i):
+                total += values[t, j]
+            # a NaN anywhere in the window propagates, like pandas' min_periods
+            out[i, j] = total / window
+
+# Compiled eagerly for the one signature we call it with, so a short-lived run
+# does not pay JIT latency on first call (and cache=True skips it next time).
+if njit is not None:
+    rolling_mean_shift1 = njit("void(float64[:, :], int64, float64[:, :])", cache=True)(
+        _rolling_mean_shift1
+    )
+else:
+    rolling_mean_shift1 = _rolling_mean_shift1
+
+def dumps_json(obj, indent=False):
+    """UTF-8 JSON bytes for obj (non-ASCII kept as-is), via orjson when available."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+    return json.dumps(obj, ensure_ascii=False, indent=2 if indent else None).encode("utf-8")
+
+def loads_json(data):
+    return orjson.loads(data) if orjson is not None else json.loads(data)
 
 def load_state():
     if not os.path.exists(STATE_FILE):
         return {"cursor": 0}
     try:
-        with open(STATE_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
+        with open(STATE_FILE, "rb") as f:
+            return loads_json(f.read())
     except Exception:
         return {"cursor": 0}
 
 def save_state(state):
-    with open(STATE_FILE, "w", encoding="utf-8") as f:
-        json.dump(state, f, ensure_ascii=False, indent=2)
+    with open(STATE_FILE, "wb") as f:
+        f.write(dumps_json(state, indent=True))
 
 # =========================
-# Main
+# Data + scoring (cached per input file version)
 # =========================
-def main():
-    if not os.path.exists(DATA_FILE):
-        raise FileNotFoundError(f"Missing input file: {DATA_FILE}")
-
-    df = pd.read_csv(DATA_FILE)
+def input_file():
+    if os.path.exists(DATA_FILE_PARQUET):
+        return DATA_FILE_PARQUET
+    if os.path.exists(DATA_FILE):
+        return DATA_FILE
+    raise FileNotFoundError(f"Missing input file: {DATA_FILE_PARQUET} or {DATA_FILE}")
+
+@lru_cache(maxsize=1)
+def load_candidates(data_file, mtime):
+    """Scored candidate days for one version of data_file.
+
+    mtime is only part of the cache key: a long-lived process (run_service.py)
+    reloads when the file is rewritten and otherwise reuses the frame.
+    Across processes the frame is persisted in BASELINES_FILE, so a fresh run
+    only recomputes it when data_file or this script (thresholds, start date)
+    is newer. Callers must not mutate the returned DataFrame.
+    """
+    if os.path.exists(BASELINES_FILE) and os.path.getmtime(BASELINES_FILE) >= max(
+        mtime, os.path.getmtime(__file__)
+    ):
+        return pd.read_parquet(BASELINES_FILE)
+
+    candidates = compute_candidates(data_file)
+
+    # write-then-rename so a concurrent reader never sees a partial file
+    tmp_file = f"{BASELINES_FILE}.tmp"
+    candidates.to_parquet(tmp_file, index=False)
+    os.replace(tmp_file, BASELINES_FILE)
+    return candidates
+
+def compute_candidates(data_file):
+    # Only the columns scored here are loaded (not the revenue_* audit columns).
+    # Parquet (written by build_daily_kpi.py) already has a datetime64 date; the
+    # CSV fallback parses it and the count dtypes in the same read.
+    required = {"date", *METRICS}
+    if data_file == DATA_FILE_PARQUET:
+        available = set(pq.read_schema(data_file).names)
+        df = pd.read_parquet(data_file, columns=[c for c in ["date", *METRICS] if c in available])
+    else:
+        df = pd.read_csv(
+            data_file,
+            usecols=lambda c: c in required,
+            dtype={"orders_count": "int32", "canceled_orders": "int32"},
+            parse_dates=["date"],
+        )
 
-    required = {"date", "orders_count", "revenue", "canceled_orders", "avg_order_value"}
     missing = required - set(df.columns)
     if missing:
-        raise ValueError(f"daily_ops_metrics.csv missing columns: {missing}")
+        raise ValueError(f"{os.path.basename(data_file)} missing columns: {missing}")
 
-    df["date"] = pd.to_datetime(df["date"], errors="coerce")
     df = df.sort_values("date").reset_index(drop=True)
 
     # rolling baseline from previous 7 calendar days (shift avoids leakage)
-    for col in ["orders_count", "revenue", "canceled_orders", "avg_order_value"]:
-        df[f"base_{col}"] = df[col].rolling(ROLLING_DAYS).mean().shift(1)
+    values = df[METRICS].to_numpy(dtype="float64", copy=True)  # writable, as the kernel signature expects
+    baselines = np.empty_like(values)
+    rolling_mean_shift1(values, ROLLING_DAYS, baselines)
+    df[[f"base_{col}" for col in METRICS]] = baselines
 
-    candidates = df.dropna(
-        subset=[f"base_{c}" for c in ["orders_count", "revenue", "canceled_orders", "avg_order_value"]]
-    ).copy()
+    candidates = df.dropna(subset=[f"base_{c}" for c in METRICS]).copy()
 
     # ✅ 只从 2017-01-12 之后开始模拟（保证 01/05~01/11 是 baseline）
     candidates = candidates[candidates["date"] >= pd.to_datetime(SIM_START_DATE)].reset_index(drop=True)
@@ -83,76 +208,55 @@ def main():
     if candidates.empty:
         raise ValueError("No candidate rows after SIM_START_DATE. Check SIM_START_DATE or data coverage.")
 
+    # score every candidate day at once; a run only reads its cursor's entries
+    score_signals(candidates)
+    return candidates
+
+# =========================
+# Main
+# =========================
+def run_once(cursor=None):
+    """Report one simulated day and advance the cursor; returns the payload.
+
+    cursor defaults to the one saved in STATE_FILE.
+    """
+    data_file = input_file()
+    candidates = load_candidates(data_file, os.path.getmtime(data_file))
+
     state = load_state()
-    cursor = int(state.get("cursor", 0))
+    if cursor is None:
+        cursor = int(state.get("cursor", 0))
 
     # 防止越界：跑到最后就回到 0（你也可以改成 stop）
     if cursor >= len(candidates):
         cursor = 0
 
-    row = candidates.iloc[cursor]
+    date_str = candidates["date"].iat[cursor].strftime("%Y-%m-%d")
+    today = {col: candidates[col].iat[cursor] for col in METRICS}
+    base = {col: candidates[f"base_{col}"].iat[cursor] for col in METRICS}
 
-    date_str = row["date"].strftime("%Y-%m-%d")
     signals = []
-
-    # Revenue drop
-    rev_today = float(row["revenue"])
-    rev_base = float(row["base_revenue"])
-    rev_change = pct_change(rev_today, rev_base)
-    if rev_change <= -TH["revenue_drop_medium"]:
-        sev = "high" if abs(rev_change) >= TH["revenue_drop_high"] else "medium"
+    for metric, col, direction, _, label in SIGNAL_RULES:
+        sev = candidates[f"severity_{col}"].iat[cursor]
+        if not sev:
+            continue
+        change = candidates[f"change_{col}"].iat[cursor]
+        sign = "+" if direction == "up" else ""
         signals.append({
-            "metric": "revenue",
-            "direction": "down",
+            "metric": metric,
+            "direction": direction,
             "severity": sev,
-            "details": f"Revenue {round(rev_change*100)}% vs {ROLLING_DAYS}-day avg"
-        })
-
-    # Orders drop
-    ord_today = float(row["orders_count"])
-    ord_base = float(row["base_orders_count"])
-    ord_change = pct_change(ord_today, ord_base)
-    if ord_change <= -TH["orders_drop_medium"]:
-        sev = "high" if abs(ord_change) >= TH["orders_drop_high"] else "medium"
-        signals.append({
-            "metric": "orders",
-            "direction": "down",
-            "severity": sev,
-            "details": f"Orders {round(ord_change*100)}% vs {ROLLING_DAYS}-day avg"
-        })
-
-    # AOV drop
-    aov_today = float(row["avg_order_value"])
-    aov_base = float(row["base_avg_order_value"])
-    aov_change = pct_change(aov_today, aov_base)
-    if aov_change <= -TH["aov_drop_medium"]:
-        sev = "high" if abs(aov_change) >= TH["aov_drop_high"] else "medium"
-        signals.append({
-            "metric": "avg_order_value",
-            "direction": "down",
-            "severity": sev,
-            "details": f"AOV {round(aov_change*100)}% vs {ROLLING_DAYS}-day avg"
-        })
-
-    # Cancellation spike
-    can_today = float(row["canceled_orders"])
-    can_base = float(row["base_canceled_orders"])
-    can_change = pct_change(can_today, can_base)
-    if can_change >= TH["cancel_spike_medium"]:
-        sev = "high" if can_change >= TH["cancel_spike_high"] else "medium"
-        signals.append({
-            "metric": "canceled_orders",
-            "direction": "up",
-            "severity": sev,
-            "details": f"Cancellations +{round(can_change*100)}% vs {ROLLING_DAYS}-day avg"
+            "details": f"{label} {sign}{round(change*100)}% vs {ROLLING_DAYS}-day avg"
         })
 
     status = "anomaly_detected" if signals else "normal"
 
     summary_lines = [
         f"Date: {date_str} | Status: {status}",
-        f"Orders: {int(ord_today)} (avg {ord_base:.1f}) | Revenue: {rev_today:.2f} (avg {rev_base:.2f})",
-        f"Canceled: {int(can_today)} (avg {can_base:.1f}) | AOV: {aov_today:.2f} (avg {aov_base:.2f})",
+        f"Orders: {int(today['orders_count'])} (avg {base['orders_count']:.1f}) | "
+        f"Revenue: {today['revenue']:.2f} (avg {base['revenue']:.2f})",
+        f"Canceled: {int(today['canceled_orders'])} (avg {base['canceled_orders']:.1f}) | "
+        f"AOV: {today['avg_order_value']:.2f} (avg {base['avg_order_value']:.2f})",
     ]
     if signals:
         summary_lines.append("Signals:")
@@ -171,11 +275,16 @@ def main():
     }
 
     # stdout（你终端能看到）
-    print(json.dumps(payload, ensure_ascii=False, indent=2))
+    print(dumps_json(payload, indent=True).decode("utf-8"))
 
     # push to n8n
     try:
-        r = requests.post(WEBHOOK_URL, json=payload, timeout=8)
+        r = SESSION.post(
+            WEBHOOK_URL,
+            data=dumps_json(payload),
+            headers={"Content-Type": "application/json"},
+            timeout=8,
+        )
         print("Webhook status:", r.status_code)
     except Exception as e:
         print(f"Webhook POST failed: {e}")
@@ -184,5 +293,10 @@ def main():
     state["cursor"] = cursor + 1
     save_state(state)
 
+    return payload
+
+def main():
+    run_once()
+
 if __name__ == "__main__":
     main()
@@ -1,15 +1,20 @@
 from flask import Flask, request, jsonify
-import subprocess
 import os
+import threading
+import traceback
 
-app = Flask(__name__)
+# Imported once per worker: pandas/numba start-up and the scored frame are
+# reused across /run calls instead of paid for by a fresh python3 each time.
+from detect_anomalies import run_once
 
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-SCRIPT = os.path.join(BASE_DIR, "detect_anomalies.py")
+app = Flask(__name__)
 
 # 简单鉴权：防止别人随便触发你本地脚本
 TOKEN = os.environ.get("OPS_AGENT_TOKEN", "kiren-ops-123")
 
+# run_once reads and advances the cursor in run_state.json; one run at a time
+RUN_LOCK = threading.Lock()
+
 @app.get("/health")
 def health():
     return jsonify({"ok": True})
@@ -19,19 +24,19 @@ def run():
     if request.headers.get("X-OPS-TOKEN", "") != TOKEN:
         return jsonify({"error": "unauthorized"}), 401
 
-    result = subprocess.run(
-        ["python3", SCRIPT],
-        cwd=BASE_DIR,
-        capture_output=True,
-        text=True,
-        timeout=120
-    )
+    try:
+        with RUN_LOCK:
+            payload = run_once()
+    except Exception:
+        return jsonify({
+            "exit_code": 1,
+            "stderr": traceback.format_exc()[-4000:],
+        }), 200
 
     return jsonify({
-        "exit_code": result.returncode,
-        "stdout": result.stdout[-4000:],
-        "stderr": result.stderr[-4000:],
+        "exit_code": 0,
+        "payload": payload,
     }), 200
 
 if __name__ == "__main__":
-    app.run(host="127.0.0.1", port=5001)
\ No newline at end of file
+    app.run(host="127.0.0.1", port=5001)